@@ -4,24 +4,94 @@
 
 import os
 import asyncpg
+import orjson
 
-async def create_db_pool():
-    """Create database connection pool"""
-    database_url = f"postgresql://{os.getenv('PGUSER', 'postgres')}:{os.getenv('PGPASSWORD', '')}@{os.getenv('PGHOST', 'localhost')}:{os.getenv('PGPORT', '5432')}/{os.getenv('PGDATABASE', 'telemetry')}"
-    return await asyncpg.create_pool(database_url)
+def get_database_url():
+    """Build the Postgres connection URL from PG* environment variables"""
+    return f"postgresql://{os.getenv('PGUSER', 'postgres')}:{os.getenv('PGPASSWORD', '')}@{os.getenv('PGHOST', 'localhost')}:{os.getenv('PGPORT', '5432')}/{os.getenv('PGDATABASE', 'telemetry')}"
 
-async def ensure_events_table(pool):
+DATABASE_URL = get_database_url()
+
+def get_pool_settings():
+    """Pool sizing and timeouts, overridable via PG_POOL_* environment variables"""
+    max_size = int(os.getenv("PG_POOL_MAX", "50"))
+    # Clamp so e.g. PG_POOL_MAX=5 alone doesn't trip min_size > max_size
+    min_size = min(int(os.getenv("PG_POOL_MIN", "10")), max_size)
+    return {
+        "min_size": min_size,
+        "max_size": max_size,
+        "max_inactive_connection_lifetime": float(os.getenv("PG_POOL_MAX_INACTIVE_LIFETIME", "300")),
+        "command_timeout": float(os.getenv("PG_COMMAND_TIMEOUT", "10")),
+    }
+
+INSERT_EVENT_SQL = "INSERT INTO events(event_type, user_id, properties, captured_at) VALUES ($1, $2, $3, $4)"
+EVENT_COLUMNS = ["event_type", "user_id", "properties", "captured_at"]
+
+class TelemetryConnection(asyncpg.Connection):
+    """Pool connection that carries a prepared events INSERT"""
+    insert_stmt = None
+
+def _encode_jsonb(value):
+    # Binary jsonb is a version byte followed by the JSON text
+    return b"\x01" + orjson.dumps(value)
+
+def _decode_jsonb(data):
+    return orjson.loads(data[1:])
+
+async def init_connection(connection):
+    """Register the JSONB codec and prepare the events INSERT once per pooled connection"""
+    # Binary format so the codec also applies to copy_records_to_table
+    await connection.set_type_codec(
+        "jsonb",
+        encoder=_encode_jsonb,
+        decoder=_decode_jsonb,
+        schema="pg_catalog",
+        format="binary"
+    )
+    connection.insert_stmt = await connection.prepare(INSERT_EVENT_SQL)
+
+async def ensure_events_table(connection):
     """Ensure events table exists (idempotent)"""
-    async with pool.acquire() as connection:
-        await connection.execute("""
-            CREATE TABLE IF NOT EXISTS events (
-                id SERIAL PRIMARY KEY,
-                event_type TEXT,
-                user_id TEXT,
-                properties JSONB,
-                captured_at TIMESTAMPTZ DEFAULT NOW()
-            );
-        """)
+    await connection.execute("""
+        CREATE TABLE IF NOT EXISTS events (
+            id SERIAL PRIMARY KEY,
+            event_type TEXT,
+            user_id TEXT,
+            properties JSONB,
+            captured_at TIMESTAMPTZ DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS idx_events_captured_at ON events (captured_at);
+        CREATE INDEX IF NOT EXISTS idx_events_type_captured_at ON events (event_type, captured_at);
+    """)
+
+async def create_db_pool(init=None):
+    """Ensure the schema, then create the database connection pool.
+
+    init_connection always runs on new connections; an optional init callback runs after it.
+    """
+    # Schema must exist before pooled connections prepare statements against it
+    connection = await asyncpg.connect(DATABASE_URL)
+    try:
+        await ensure_events_table(connection)
+        print("✅ Database schema ensured")
+    except Exception as err:
+        # Best-effort: the role may lack CREATE (schema made by scripts/init_db.sh) or
+        # another worker may be racing the same DDL. init_connection's prepare still
+        # fails loudly if the table is really missing.
+        print(f"❌ Failed to ensure DB schema: {err}")
+    finally:
+        await connection.close()
+    async def _init(connection):
+        await init_connection(connection)
+        if init is not None:
+            await init(connection)
+
+    return await asyncpg.create_pool(
+        DATABASE_URL,
+        connection_class=TelemetryConnection,
+        init=_init,
+        **get_pool_settings()
+    )
 
 # ---------------------------------------------------------------------------
 # Stand-alone test helper
@@ -32,10 +102,9 @@ if __name__ == "__main__":
     async def _test():
         pool = await create_db_pool()
         try:
-            await ensure_events_table(pool)
             async with pool.acquire() as conn:
                 await conn.execute("SELECT 1")
             print("✅ Database connection successful")
         finally:
             await pool.close()
-    asyncio.run(_test())
\ No newline at end of file
+    asyncio.run(_test())
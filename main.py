@@ -1,13 +1,15 @@
 # main.py - FastAPI telemetry server
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse
 import uvicorn
 import os
-import json
+import logging
+import orjson
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Dict, List, Any, Optional
+import aiofiles
 import asyncpg
 import asyncio
 from contextlib import asynccontextmanager
@@ -16,96 +18,268 @@ from dotenv import load_dotenv
 # Load environment variables from .env file
 load_dotenv()
 
-# Database configuration
-DATABASE_URL = f"postgresql://{os.getenv('PGUSER', 'postgres')}:{os.getenv('PGPASSWORD', '')}@{os.getenv('PGHOST', 'localhost')}:{os.getenv('PGPORT', '5432')}/{os.getenv('PGDATABASE', 'telemetry')}"
+from db import EVENT_COLUMNS, create_db_pool
+import uring_log
+
+# Per-event payload logging is DEBUG-only; set LOG_LEVEL=debug to see it
+LOG_LEVEL_NAME = os.getenv("LOG_LEVEL", "info")
+# Unknown names (e.g. uvicorn's "trace") fall back to INFO instead of failing the import
+_log_level = getattr(logging, LOG_LEVEL_NAME.upper(), None)
+if not isinstance(_log_level, int):
+    _log_level = None
+logging.basicConfig(level=logging.INFO if _log_level is None else _log_level, format="%(message)s")
+logger = logging.getLogger("telemetry")
+if _log_level is None:
+    logger.warning(f"⚠️ Unknown LOG_LEVEL {LOG_LEVEL_NAME!r}, using info")
 
 # Global database pool
 db_pool = None
 
-async def ensure_schema():
-    """Ensure events table exists on startup (idempotent)"""
-    try:
-        async with db_pool.acquire() as connection:
-            await connection.execute("""
-                CREATE TABLE IF NOT EXISTS events (
-                    id SERIAL PRIMARY KEY,
-                    event_type TEXT,
-                    user_id TEXT,
-                    properties JSONB,
-                    captured_at TIMESTAMPTZ DEFAULT NOW()
-                );
-            """)
-        print("✅ Database schema ensured")
-    except Exception as err:
-        print(f"❌ Failed to ensure DB schema: {err}")
+# Single events waiting to be flushed to Postgres by the background flusher
+insert_queue: Optional[asyncio.Queue] = None
+INSERT_QUEUE_MAXSIZE = 10000
+FLUSH_MAX_EVENTS = 500
+FLUSH_INTERVAL = 0.02  # seconds to wait for more events after the first one
+
+# Encoded JSONL chunks waiting to be appended to the log file by the background writer
+log_queue: Optional[asyncio.Queue] = None
+LOG_FLUSH_MAX_CHUNKS = 1000
+LOG_FLUSH_INTERVAL = 0.05
+# "posix" uses aiofiles; "uring" uses io_uring via liburing when available
+LOG_BACKEND = os.getenv("LOG_BACKEND", "posix")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    global db_pool
+    global db_pool, insert_queue, log_queue
     try:
-        db_pool = await asyncpg.create_pool(DATABASE_URL)
-        await ensure_schema()
+        db_pool = await create_db_pool()
         print("✅ Database pool created")
     except Exception as e:
+        # Refuse to start rather than silently dropping events
         print(f"❌ Failed to create database pool: {e}")
-        db_pool = None
+        raise
     
     # Ensure logs directory exists
     logs_dir = Path("logs")
     logs_dir.mkdir(exist_ok=True)
+    if LOG_BACKEND == "uring" and not uring_log.available():
+        print("⚠️ LOG_BACKEND=uring but liburing is not installed, falling back to aiofiles")
+    
+    insert_queue = asyncio.Queue(maxsize=INSERT_QUEUE_MAXSIZE)
+    log_queue = asyncio.Queue()
+    flusher = asyncio.create_task(_flusher())
+    log_writer = asyncio.create_task(_log_writer())
     
     yield
     
-    # Shutdown
-    if db_pool:
-        await db_pool.close()
-        print("✅ Database pool closed")
+    # Shutdown - the sentinel lets the flusher drain everything queued before it
+    await insert_queue.put(None)
+    log_queue.put_nowait(None)
+    await flusher
+    await log_writer
+    print("✅ Insert and log queues drained")
+    
+    await db_pool.close()
+    print("✅ Database pool closed")
 
 app = FastAPI(
     title="Cline Telemetry Server",
     description="Minimal telemetry server for Cline",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
 # Note: Static file mounting moved to end of file to prevent API route conflicts
 
-# Helper function to append events
-async def append_event(event: Dict[str, Any]):
-    """Log event to file and database"""
-    # Legacy file logging (optional)
-    today = datetime.now().date().isoformat()
-    log_file = Path("logs") / f"telemetry-{today}.jsonl"
-    
+# Batches larger than this go through COPY instead of executemany
+COPY_THRESHOLD = 500
+
+def _parse_ts(event: Dict[str, Any]) -> datetime:
+    """Return the event timestamp as an aware datetime"""
+    ts = event.get("timestamp")
+    # Server-assigned timestamps are already datetimes; only client strings need parsing
+    if isinstance(ts, datetime):
+        return ts
+    if ts:
+        try:
+            return datetime.fromisoformat(ts.replace("Z", "+00:00"))
+        except (AttributeError, TypeError, ValueError):
+            # Keep the event (it is already in the JSONL log) with the server's time
+            print(f"⚠️ Invalid timestamp {ts!r}, using server time")
+    return datetime.now(timezone.utc)
+
+def _text(value: Any) -> Optional[str]:
+    """Coerce a client value for a TEXT column (e.g. "event": 5) so it can't fail the batch"""
+    if value is None or isinstance(value, str):
+        return value
+    return orjson.dumps(value).decode()
+
+def _event_row(event: Dict[str, Any]) -> tuple:
+    """Build the INSERT parameters for an event"""
+    return (
+        _text(event.get("event")),
+        _text(event.get("user_id")),
+        event.get("properties") or None,
+        _parse_ts(event)
+    )
+
+def _log_events(events: List[Dict[str, Any]]):
+    """Queue events for today's legacy JSONL log as a single chunk"""
+    log_queue.put_nowait(b"".join(orjson.dumps(event) + b"\n" for event in events))
+
+async def insert_events(events: List[Dict[str, Any]]):
+    """Write a batch of events to Postgres on a single connection"""
+    if not events:
+        return
+    rows = []
+    for event in events:
+        try:
+            rows.append(_event_row(event))
+        except Exception as e:
+            print(f"❌ Skipping malformed event {event.get('event')!r}: {e}")
+    if not rows:
+        return
     try:
-        with open(log_file, "a") as f:
-            f.write(json.dumps(event) + "\n")
+        async with db_pool.acquire() as connection:
+            # Both paths are a single atomic, pipelined statement, so an explicit
+            # transaction would only add BEGIN/COMMIT round-trips. Auxiliary writes
+            # (e.g. counter upserts) should share one connection.transaction() block.
+            try:
+                if len(rows) > COPY_THRESHOLD:
+                    await connection.copy_records_to_table("events", records=rows, columns=EVENT_COLUMNS)
+                else:
+                    await connection.insert_stmt.executemany(rows)
+            except ROW_DATA_ERRORS as e:
+                # The batch is atomic, so nothing was written - retry row by row so
+                # one bad event doesn't discard events that were already acknowledged
+                print(f"⚠️ DB batch insert error, retrying {len(rows)} rows individually: {e}")
+                await _insert_rows_individually(connection, rows)
     except Exception as e:
-        print(f"⚠️ File logging error: {e}")
-    
-    # Also write to Postgres (non-blocking)
-    if db_pool:
+        # Timeouts and connection errors aren't about the data; retrying row by row
+        # would only stall the flusher, so the batch is dropped
+        print(f"❌ DB batch insert error, dropped {len(rows)} events: {e}")
+
+# Errors caused by a row's content (client-side encoding errors are ValueError/TypeError
+# subclasses; server-side they are SQLSTATE class 22/23), so other rows can still succeed
+ROW_DATA_ERRORS = (
+    ValueError,
+    TypeError,
+    asyncpg.DataError,
+    asyncpg.IntegrityConstraintViolationError,
+)
+
+async def _insert_rows_individually(connection, rows: List[tuple]):
+    """Fallback for a failed batch: insert each row, logging only the ones that fail"""
+    for i, row in enumerate(rows):
         try:
-            async with db_pool.acquire() as connection:
-                await connection.execute(
-                    "INSERT INTO events(event_type, user_id, properties, captured_at) VALUES ($1, $2, $3, $4)",
-                    event.get("event"),
-                    event.get("user_id"),
-                    json.dumps(event.get("properties")) if event.get("properties") else None,
-                    datetime.fromisoformat(event["timestamp"].replace("Z", "+00:00")) if event.get("timestamp") else datetime.now(timezone.utc)
-                )
+            await connection.insert_stmt.fetch(*row)
+        except ROW_DATA_ERRORS as e:
+            print(f"❌ DB insert error for event {row[0]!r}: {e}")
         except Exception as e:
-            print(f"❌ DB insert error: {e}")
+            print(f"❌ DB insert error, dropped the remaining {len(rows) - i} events: {e}")
+            return
+
+async def _drain_batch(queue: asyncio.Queue, max_items: int, interval: float):
+    """Wait for one item, then collect more until max_items or interval has passed.
+
+    Returns (batch, stopping) where stopping means the None shutdown sentinel was seen.
+    """
+    first = await queue.get()
+    if first is None:
+        return [], True
+    loop = asyncio.get_running_loop()
+    batch = [first]
+    deadline = loop.time() + interval
+    while len(batch) < max_items:
+        if queue.empty():
+            # Only block (one Task + timer) once everything queued has been taken
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+        else:
+            item = queue.get_nowait()
+        if item is None:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+async def _flusher():
+    """Drain insert_queue in batches of up to FLUSH_MAX_EVENTS or FLUSH_INTERVAL"""
+    while True:
+        batch, stopping = await _drain_batch(insert_queue, FLUSH_MAX_EVENTS, FLUSH_INTERVAL)
+        try:
+            await insert_events(batch)
+        except Exception as e:
+            # Never let the task die - a dead flusher fills the queue and hangs /capture/
+            print(f"❌ Insert flusher error, dropped {len(batch)} events: {e}")
+        if stopping:
+            return
+
+def _log_path(day: str) -> Path:
+    return Path("logs") / f"telemetry-{day}.jsonl"
+
+async def _open_log_file(path: Path):
+    """Open an append-only log handle for the configured LOG_BACKEND"""
+    if LOG_BACKEND == "uring" and uring_log.available():
+        try:
+            # Ring setup and open() are blocking syscalls, keep them off the event loop
+            return await asyncio.get_running_loop().run_in_executor(None, uring_log.UringLogFile, path)
+        except OSError as e:
+            # e.g. io_uring disabled by the kernel or a container seccomp profile
+            print(f"⚠️ io_uring unavailable ({e}), falling back to aiofiles")
+    return await aiofiles.open(path, "ab")
+
+async def _log_writer():
+    """Drain log_queue into today's JSONL file, one write per batch"""
+    day = None
+    f = None
+    try:
+        while True:
+            chunks, stopping = await _drain_batch(log_queue, LOG_FLUSH_MAX_CHUNKS, LOG_FLUSH_INTERVAL)
+            if chunks:
+                try:
+                    # Rotate the handle when the date changes
+                    today = datetime.now().date().isoformat()
+                    if today != day:
+                        if f:
+                            await f.close()
+                        f = None
+                        f = await _open_log_file(_log_path(today))
+                        day = today
+                    await f.writelines(chunks)
+                    await f.flush()
+                except Exception as e:
+                    print(f"⚠️ File logging error: {e}")
+            if stopping:
+                return
+    finally:
+        if f:
+            await f.close()
+
+# Helper function to append events
+async def append_event(event: Dict[str, Any]):
+    """Log event to file and database"""
+    # Legacy file logging (optional) - written by the background log writer
+    log_queue.put_nowait(orjson.dumps(event) + b"\n")
+    
+    # Postgres write is batched by the background flusher
+    await insert_queue.put(event)
 
 # Capture endpoints (single + batch)
 @app.post("/capture/")
 async def capture_event(request: Request):
     """Capture a single telemetry event"""
     try:
-        body = await request.json()
-        event = {"timestamp": datetime.now(timezone.utc).isoformat(), **body}
-        print(f"📊 Telemetry Event: {json.dumps(event, indent=2)}")
+        body = orjson.loads(await request.body())
+        event = {"timestamp": datetime.now(timezone.utc), **body}
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📊 Telemetry Event: %s", orjson.dumps(event).decode())
         await append_event(event)
         return {"status": 1}
     except Exception as err:
@@ -116,13 +290,20 @@ async def capture_event(request: Request):
 async def capture_batch(request: Request):
     """Capture a batch of telemetry events"""
     try:
-        body = await request.json()
+        body = orjson.loads(await request.body())
         batch = body.get("batch", [])
+        if not batch:
+            return {"status": 1}
+        
+        # One log chunk and one executemany/COPY for the whole batch
+        now = datetime.now(timezone.utc)
+        events = [{"timestamp": now, **ev} for ev in batch]
+        if logger.isEnabledFor(logging.DEBUG):
+            for event in events:
+                logger.debug("📊 Telemetry Event: %s", orjson.dumps(event).decode())
         
-        for ev in batch:
-            event = {"timestamp": datetime.now(timezone.utc).isoformat(), **ev}
-            print(f"📊 Telemetry Event: {json.dumps(event, indent=2)}")
-            await append_event(event)
+        _log_events(events)
+        await insert_events(events)
         
         return {"status": 1}
     except Exception as err:
@@ -135,97 +316,127 @@ async def health_check():
     """Health check endpoint"""
     return {"status": "ok", "timestamp": datetime.now(timezone.utc).isoformat()}
 
+# Readiness endpoint (database reachable)
+READY_ACQUIRE_TIMEOUT = 2  # seconds; an exhausted pool reports 503 instead of hanging
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness probe - reports whether the database pool can serve queries"""
+    try:
+        async with db_pool.acquire(timeout=READY_ACQUIRE_TIMEOUT) as connection:
+            await connection.fetchval("SELECT 1", timeout=READY_ACQUIRE_TIMEOUT)
+    except Exception as err:
+        print(f"❌ Readiness check failed: {err}")
+        return ORJSONResponse({"status": "unavailable", "database": "error"}, status_code=503)
+    return {"status": "ok", "database": "ok", "pool_size": db_pool.get_size(), "pool_idle": db_pool.get_idle_size()}
+
+# Stats queries - aggregation happens in Postgres so only grouped rows come back
+STATS_WINDOW = "captured_at >= NOW() - INTERVAL '30 days'"
+
+STATS_TOTALS_SQL = f"""
+    SELECT event_type, COUNT(*) AS count
+    FROM events
+    WHERE {STATS_WINDOW}
+    GROUP BY event_type
+"""
+
+STATS_FEEDBACK_SQL = f"""
+    SELECT COALESCE(properties->>'feedbackType', properties->>'feedback_type') AS feedback, COUNT(*) AS count
+    FROM events
+    WHERE event_type = 'task.feedback' AND {STATS_WINDOW}
+    GROUP BY feedback
+"""
+
+STATS_TOKENS_SQL = f"""
+    SELECT
+        COUNT(*) AS turns,
+        COALESCE(SUM((properties->>'tokensIn')::numeric), 0) AS tokens_in,
+        COALESCE(SUM((properties->>'tokensOut')::numeric), 0) AS tokens_out,
+        COALESCE(SUM((properties->>'cacheReadTokens')::numeric), 0) AS cache_read,
+        COALESCE(SUM((properties->>'cacheWriteTokens')::numeric), 0) AS cache_write,
+        COALESCE(SUM((properties->>'totalCost')::float8), 0) AS cost
+    FROM events
+    WHERE event_type = 'task.conversation_turn' AND properties->>'source' = 'assistant' AND {STATS_WINDOW}
+"""
+
+STATS_TOOLS_SQL = f"""
+    SELECT COALESCE(properties->>'tool', 'unknown') AS tool, COUNT(*) AS count
+    FROM events
+    WHERE event_type = 'task.tool_used' AND {STATS_WINDOW}
+    GROUP BY tool
+"""
+
 # Stats endpoint (aggregated counts)
 @app.get("/stats")
 async def get_stats():
     """Get aggregated statistics for the last 30 days"""
     try:
-        if not db_pool:
-            return {"totals": {}, "accepted": {}, "rejected": {}, "tokens": {}}
-        
         async with db_pool.acquire() as connection:
-            rows = await connection.fetch(
-                "SELECT event_type, properties FROM events WHERE captured_at >= NOW() - INTERVAL '30 days'"
-            )
+            type_rows = await connection.fetch(STATS_TOTALS_SQL)
+            feedback_rows = await connection.fetch(STATS_FEEDBACK_SQL)
+            token_row = await connection.fetchrow(STATS_TOKENS_SQL)
+            tool_rows = await connection.fetch(STATS_TOOLS_SQL)
         
-        totals = {}
-        accepted = {"option_selected": 0, "thumbs_up": 0}
-        rejected = {"options_ignored": 0, "thumbs_down": 0}
+        # Rows are unpacked positionally in the column order of the STATS_* queries
+        totals = {event_type: count for event_type, count in type_rows}
+        feedback = {fb: count for fb, count in feedback_rows}
+        accepted = {
+            "option_selected": totals.get("task.option_selected", 0),
+            "thumbs_up": feedback.get("thumbs_up", 0)
+        }
+        rejected = {
+            "options_ignored": totals.get("task.options_ignored", 0),
+            "thumbs_down": feedback.get("thumbs_down", 0)
+        }
         
-        # Token metrics
+        # Token metrics (assistant turns only - they carry token data)
+        turns, tokens_in, tokens_out, cache_read, cache_write, cost = token_row
         tokens = {
-            "total_tokens_in": 0,
-            "total_tokens_out": 0,
-            "total_cache_read": 0,
-            "total_cache_write": 0,
-            "total_cost": 0.0,
-            "conversation_turns": 0
+            "total_tokens_in": int(tokens_in),
+            "total_tokens_out": int(tokens_out),
+            "total_cache_read": int(cache_read),
+            "total_cache_write": int(cache_write),
+            "total_cost": float(cost),
+            "conversation_turns": turns
         }
         
         # Tool usage tracking
-        tool_usage = {}
-        
-        for row in rows:
-            event_type = row["event_type"]
-            totals[event_type] = totals.get(event_type, 0) + 1
-            
-            if event_type == "task.option_selected":
-                accepted["option_selected"] += 1
-            elif event_type == "task.options_ignored":
-                rejected["options_ignored"] += 1
-            elif event_type == "task.feedback":
-                properties = json.loads(row["properties"]) if row["properties"] else {}
-                fb = properties.get("feedbackType") or properties.get("feedback_type")
-                if fb == "thumbs_up":
-                    accepted["thumbs_up"] += 1
-                elif fb == "thumbs_down":
-                    rejected["thumbs_down"] += 1
-            elif event_type == "task.conversation_turn":
-                properties = json.loads(row["properties"]) if row["properties"] else {}
-                # Only count assistant turns for token metrics (they have token data)
-                if properties.get("source") == "assistant":
-                    tokens["conversation_turns"] += 1
-                    tokens["total_tokens_in"] += properties.get("tokensIn", 0)
-                    tokens["total_tokens_out"] += properties.get("tokensOut", 0)
-                    tokens["total_cache_read"] += properties.get("cacheReadTokens", 0)
-                    tokens["total_cache_write"] += properties.get("cacheWriteTokens", 0)
-                    tokens["total_cost"] += properties.get("totalCost", 0.0)
-            elif event_type == "task.tool_used":
-                properties = json.loads(row["properties"]) if row["properties"] else {}
-                tool_name = properties.get("tool", "unknown")
-                tool_usage[tool_name] = tool_usage.get(tool_name, 0) + 1
+        tool_usage = {tool: count for tool, count in tool_rows}
         
         return {"totals": totals, "accepted": accepted, "rejected": rejected, "tokens": tokens, "tools": tool_usage}
     except Exception as err:
         print(f"❌ Stats error: {err}")
         raise HTTPException(status_code=500, detail="Stats failed")
 
+# Range on captured_at (rather than captured_at::date) so the index can be used
+RECENT_EVENTS_SQL = """
+    SELECT id, event_type, user_id, properties, captured_at
+    FROM events
+    WHERE captured_at >= date_trunc('day', NOW()) AND captured_at < date_trunc('day', NOW()) + INTERVAL '1 day'
+    ORDER BY id DESC
+    LIMIT 20
+"""
+
 # Recent events API (last 20 of today)
 @app.get("/api/events")
 async def get_recent_events():
     """Get recent events from today (last 20)"""
     try:
-        if not db_pool:
-            return []
-        
         async with db_pool.acquire() as connection:
-            rows = await connection.fetch(
-                "SELECT * FROM events WHERE captured_at::date = CURRENT_DATE ORDER BY id DESC LIMIT 20"
-            )
+            rows = await connection.fetch(RECENT_EVENTS_SQL)
         
+        # Positional unpacking follows the column order in RECENT_EVENTS_SQL
         events = []
-        for row in rows:
+        for event_id, event_type, user_id, properties, captured_at in rows:
             events.append({
-                "id": row["id"],
-                "event": row["event_type"],
-                "user_id": row["user_id"],
-                "properties": json.loads(row["properties"]) if row["properties"] else None,
-                "timestamp": row["captured_at"].isoformat(),
-                "event_type": row["event_type"],
-                "captured_at": row["captured_at"].isoformat()
+                "id": event_id,
+                "event_type": event_type,
+                "user_id": user_id,
+                "properties": properties,
+                "captured_at": captured_at
             })
         
-        return events
+        return ORJSONResponse(events)
     except Exception as err:
         print(f"❌ Error reading events: {err}")
         return []
@@ -233,11 +444,8 @@ async def get_recent_events():
 # Legacy dashboard (only used when React build not found)
 # Note: This route is only registered when React build is NOT available
 if not Path("frontend/dist").exists():
-    @app.get("/", response_class=HTMLResponse)
-    async def dashboard():
-        """Legacy dashboard when React build is not available"""
-        
-        html_content = f"""
+    # The page is static, so it is built and encoded once at import time
+    _LEGACY_DASHBOARD_HTML = f"""
 <!DOCTYPE html>
 <html>
 <head>
@@ -278,8 +486,8 @@ if not Path("frontend/dist").exists():
           if(events.length===0){{ div.innerHTML='<p>No events yet.</p>'; return }}
           div.innerHTML = events.map(ev => `
              <div class="event">
-               <div class="timestamp">${{ev.timestamp}}</div>
-               <div class="event-type">${{ev.event}}</div>
+               <div class="timestamp">${{ev.captured_at}}</div>
+               <div class="event-type">${{ev.event_type}}</div>
                <pre>${{JSON.stringify(ev,null,2)}}</pre>
              </div>`).join('')
         }})
@@ -318,8 +526,13 @@ if not Path("frontend/dist").exists():
   </script>
 </body>
 </html>
-        """
-        return HTMLResponse(content=html_content)
+    """
+    _LEGACY_DASHBOARD = HTMLResponse(content=_LEGACY_DASHBOARD_HTML.encode())
+
+    @app.get("/", response_class=HTMLResponse)
+    async def dashboard():
+        """Legacy dashboard when React build is not available"""
+        return _LEGACY_DASHBOARD
 
 # Serve React build (if present) – production mode
 # Mount static files AFTER all API routes to ensure API routes take precedence
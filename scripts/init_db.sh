@@ -25,6 +25,7 @@ CREATE TABLE IF NOT EXISTS events (
 );
 
 CREATE INDEX IF NOT EXISTS idx_events_captured_at ON events (captured_at);
+CREATE INDEX IF NOT EXISTS idx_events_type_captured_at ON events (event_type, captured_at);
 SQL
 
 echo "✅ Database schema ensured."
\ No newline at end of file
@@ -0,0 +1,62 @@
+# uring_log.py - Optional io_uring-backed log file for the JSONL event log
+# Enabled with LOG_BACKEND=uring. Linux only; needs the `liburing` Python package
+# (`pip install liburing`). main.py falls back to aiofiles when it is unavailable.
+
+import asyncio
+import os
+
+try:
+    import liburing
+except ImportError:
+    liburing = None
+
+# Only one writev is in flight at a time, so the ring can stay small
+QUEUE_DEPTH = 8
+# Kernel limit on the number of iovecs per writev
+IOV_MAX = 1024
+
+def available():
+    """True when the liburing bindings can be imported"""
+    return liburing is not None
+
+class UringLogFile:
+    """Append-only file that submits each batch of chunks as one writev SQE"""
+
+    def __init__(self, path):
+        self._ring = liburing.io_uring()
+        self._cqe = liburing.io_uring_cqe()
+        liburing.io_uring_queue_init(QUEUE_DEPTH, self._ring, 0)
+        try:
+            self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        except BaseException:
+            liburing.io_uring_queue_exit(self._ring)
+            raise
+
+    def _writev(self, chunks):
+        while chunks:
+            batch, chunks = chunks[:IOV_MAX], chunks[IOV_MAX:]
+            iov = liburing.iovec(batch)
+            sqe = liburing.io_uring_get_sqe(self._ring)
+            # O_APPEND makes the kernel ignore the offset and append at end of file
+            liburing.io_uring_prep_writev(sqe, self._fd, iov, len(iov), 0)
+            liburing.io_uring_submit(self._ring)
+            liburing.io_uring_wait_cqe(self._ring, self._cqe)
+            try:
+                written = liburing.trap_error(self._cqe.res)
+            finally:
+                liburing.io_uring_cqe_seen(self._ring, self._cqe)
+            # Resubmit whatever a short write left behind
+            if written < sum(len(chunk) for chunk in batch):
+                chunks = [b"".join(batch)[written:]] + chunks
+
+    async def writelines(self, chunks):
+        # The completion wait blocks, so keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self._writev, list(chunks))
+
+    async def flush(self):
+        # Completed writes are already in the kernel; nothing is buffered here
+        pass
+
+    async def close(self):
+        os.close(self._fd)
+        liburing.io_uring_queue_exit(self._ring)